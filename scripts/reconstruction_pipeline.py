@@ -2,19 +2,36 @@
 #
 # Copyright 2017: Johannes L. Schoenberger <jsch at inf.ethz.ch>
 
-from __future__ import print_function, division
-
 import os
-import sys
-import glob
+import re
 import argparse
+import shutil
+import struct
 import sqlite3
+import functools
 import subprocess
+import collections
 import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 
-IS_PYTHON3 = sys.version_info[0] >= 3
+# Patterns and types of the statistics in the model_analyzer output. They are
+# searched in the raw output bytes, so the lines may carry a logging prefix.
+MODEL_ANALYZER_PATTERNS = collections.OrderedDict([
+    ("num_reg_images",
+     (re.compile(br"Registered images\s*:?\s*(\d+)"), int)),
+    ("num_sparse_points",
+     (re.compile(br"\bPoints\s*:?\s*(\d+)"), int)),
+    ("num_observations",
+     (re.compile(br"\bObservations\s*:?\s*(\d+)"), int)),
+    ("mean_track_length",
+     (re.compile(br"Mean track length\s*:?\s*([\d.]+)"), float)),
+    ("num_observations_per_image",
+     (re.compile(br"Mean observations per image\s*:?\s*([\d.]+)"), float)),
+    ("mean_reproj_error",
+     (re.compile(br"Mean reprojection error\s*:?\s*([\d.]+)"), float)),
+])
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -23,25 +40,142 @@ def parse_args():
     parser.add_argument("--colmap_path", required=True,
                         help="Path to the COLMAP executable folder, e.g., "
                              "path/to/colmap/build/src/exe")
+    parser.add_argument("--num_matches_importers", type=int, default=1,
+                        help="Number of concurrent COLMAP matches_importer "
+                             "processes for the geometric verification, "
+                             "each working on a temporary copy of the "
+                             "database")
+    parser.add_argument("--gpu_index", default="-1",
+                        help="Comma-separated indices of the GPUs used for "
+                             "the dense stereo, e.g., 0,1,2,3 (default: all)")
     args = parser.parse_args()
     return args
 
 def image_ids_to_pair_id(image_id1, image_id2):
-    if image_id1 > image_id2:
-        return 2147483647 * image_id2 + image_id1
-    else:
-        return 2147483647 * image_id1 + image_id2
+    # Branchless, so that it can be applied element-wise to arrays of ids.
+    return 2147483647 * np.minimum(image_id1, image_id2) + \
+        np.maximum(image_id1, image_id2)
+
+def read_matrix_shape(path):
+    with open(path, "rb") as fid:
+        return tuple(map(int, np.fromfile(fid, count=2, dtype=np.int32)))
 
 def read_matrix(path, dtype):
+    # The matrix data is memory-mapped rather than copied to the heap, since
+    # it is only passed on to SQLite. Empty matrices cannot be mapped and
+    # platforms without mmap support fall back to a regular read.
     with open(path, "rb") as fid:
-        shape = np.fromfile(fid, count=2, dtype=np.int32)
+        shape = tuple(map(int, np.fromfile(fid, count=2, dtype=np.int32)))
+        if shape[0] * shape[1] > 0:
+            try:
+                return np.memmap(fid, dtype=dtype, mode="r", offset=8,
+                                 shape=shape)
+            except (OSError, ValueError):
+                fid.seek(8)
         matrix = np.fromfile(fid, count=shape[0] * shape[1], dtype=dtype)
     return matrix.reshape(shape)
 
+def array_to_blob(array):
+    # Binds the array memory to SQLite without an intermediate bytes copy.
+    return memoryview(np.ascontiguousarray(array).reshape(-1)).cast("B")
+
+def map_threaded(func, items, num_threads):
+    # Lazily yields func(item) in order, while the next items are loaded by
+    # the thread pool. The number of pending results is bounded so that the
+    # loaded matrices do not all accumulate in memory.
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        futures = collections.deque()
+        for item in items:
+            futures.append(executor.submit(func, item))
+            if len(futures) >= 2 * num_threads:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
+def read_features(args, image_name):
+    keypoint_path = os.path.join(args.dataset_path, "keypoints",
+                                 image_name + ".bin")
+    keypoints = read_matrix(keypoint_path, np.float32)
+    descriptor_path = os.path.join(args.dataset_path, "descriptors",
+                                   image_name + ".bin")
+    # The descriptors are not imported, so only their shape is validated.
+    descriptors_shape = read_matrix_shape(descriptor_path)
+    assert keypoints.shape[1] == 4
+    assert keypoints.shape[0] == descriptors_shape[0]
+    return keypoints
+
+def read_matches(match_path):
+    matches = read_matrix(match_path, np.uint32)
+    assert matches.shape[1] == 2
+    return matches
+
+def keypoint_rows(args, images, num_threads):
+    image_names = list(images.keys())
+    all_keypoints = map_threaded(
+        functools.partial(read_features, args), image_names, num_threads)
+    for image_name, keypoints in zip(image_names, all_keypoints):
+        print("Importing features for", image_name)
+        yield (images[image_name], keypoints.shape[0], keypoints.shape[1],
+               array_to_blob(keypoints))
+
+def match_rows(args, images, image_pairs, num_threads):
+    # Collect the match files and their image names in a single directory
+    # scan, which avoids the extra stat calls of glob.
+    entries = [(entry.path, entry.name[:-4].split("---"))
+               for entry in os.scandir(os.path.join(args.dataset_path,
+                                                    "matches"))
+               if entry.name.endswith(".bin") and "---" in entry.name]
+
+    get_image_id = images.__getitem__
+    image_ids1 = np.array([get_image_id(image_name1)
+                           for _, (image_name1, _) in entries], dtype=np.int64)
+    image_ids2 = np.array([get_image_id(image_name2)
+                           for _, (_, image_name2) in entries], dtype=np.int64)
+    image_pair_ids = image_ids_to_pair_id(image_ids1, image_ids2)
+
+    # Only import the first match file of every image pair, and only list
+    # the pair once for the geometric verification.
+    _, unique_idxs = np.unique(image_pair_ids, return_index=True)
+    unique_idxs.sort()
+    match_paths = []
+    for idx in unique_idxs:
+        match_path, (image_name1, image_name2) = entries[idx]
+        image_pairs.append((image_name1, image_name2))
+        print("Importing matches for", image_name1, "---", image_name2)
+        match_paths.append(match_path)
+    image_pair_ids = image_pair_ids[unique_idxs].tolist()
+
+    all_matches = map_threaded(read_matches, match_paths, num_threads)
+    for image_pair_id, matches in zip(image_pair_ids, all_matches):
+        yield (image_pair_id, matches.shape[0], matches.shape[1],
+               array_to_blob(matches))
+
+def write_image_pairs(path, image_pairs):
+    with open(path, "w") as fid:
+        fid.write("".join("{} {}\n".format(image_name1, image_name2)
+                          for image_name1, image_name2 in image_pairs))
+
 def import_matches(args):
-    connection = sqlite3.connect(os.path.join(args.dataset_path, "database.db"))
+    colmap_exe_path = os.path.join(args.colmap_path, "colmap")
+    database_path = os.path.join(args.dataset_path, "database.db")
+    image_pairs_path = os.path.join(args.dataset_path, "image-pairs.txt")
+
+    # The connection stays open while matches_importer runs. It holds no
+    # transaction at that time, so it does not lock out the single COLMAP
+    # writer of the database. Transactions are managed explicitly.
+    connection = sqlite3.connect(database_path, isolation_level=None)
     cursor = connection.cursor()
 
+    # The page size only applies to a new database and must be set before
+    # switching to WAL mode. The large page cache and memory-mapped I/O
+    # reduce the syscalls of the bulk inserts.
+    cursor.execute("PRAGMA page_size=8192;")
+    cursor.execute("PRAGMA journal_mode=WAL;")
+    cursor.execute("PRAGMA synchronous=NORMAL;")
+    cursor.execute("PRAGMA cache_size=-524288;")
+    cursor.execute("PRAGMA mmap_size=30000000000;")
+    cursor.execute("PRAGMA temp_store=MEMORY;")
+
     cursor.execute("SELECT name FROM sqlite_master "
                    "WHERE type='table' AND name='inlier_matches';")
     try:
@@ -49,6 +183,9 @@ def import_matches(args):
     except StopIteration:
         inlier_matches_table_exists = False
 
+    # Clear and insert all features and matches in a single transaction,
+    # since committing every row forces a journal flush per image and pair.
+    cursor.execute("BEGIN IMMEDIATE;")
     cursor.execute("DELETE FROM keypoints;")
     cursor.execute("DELETE FROM descriptors;")
     cursor.execute("DELETE FROM matches;")
@@ -56,75 +193,89 @@ def import_matches(args):
         cursor.execute("DELETE FROM inlier_matches;")
     else:
         cursor.execute("DELETE FROM two_view_geometries;")
-    connection.commit()
 
-    images = {}
     cursor.execute("SELECT name, image_id FROM images;")
-    for row in cursor:
-        images[row[0]] = row[1]
+    images = dict(cursor.fetchall())
 
-    for image_name, image_id in images.items():
-        print("Importing features for", image_name)
-        keypoint_path = os.path.join(args.dataset_path, "keypoints",
-                                     image_name + ".bin")
-        keypoints = read_matrix(keypoint_path, np.float32)
-        descriptor_path = os.path.join(args.dataset_path, "descriptors",
-                                     image_name + ".bin")
-        descriptors = read_matrix(descriptor_path, np.float32)
-        assert keypoints.shape[1] == 4
-        assert keypoints.shape[0] == descriptors.shape[0]
-        if IS_PYTHON3:
-            keypoints_str = keypoints.tobytes()
-        else:
-            keypoints_str = np.getbuffer(keypoints)
-        cursor.execute("INSERT INTO keypoints(image_id, rows, cols, data) "
+    # The matrices are loaded from disk in parallel, while the inserts are
+    # serialized on this thread.
+    num_threads = min(multiprocessing.cpu_count(), 16)
+
+    cursor.executemany("INSERT INTO keypoints(image_id, rows, cols, data) "
                        "VALUES(?, ?, ?, ?);",
-                       (image_id, keypoints.shape[0], keypoints.shape[1],
-                        keypoints_str))
-        connection.commit()
+                       keypoint_rows(args, images, num_threads))
 
     image_pairs = []
-    image_pair_ids = set()
-    for match_path in glob.glob(os.path.join(args.dataset_path,
-                                             "matches/*---*.bin")):
-        image_name1, image_name2 = \
-            os.path.basename(match_path[:-4]).split("---")
-        image_pairs.append((image_name1, image_name2))
-        print("Importing matches for", image_name1, "---", image_name2)
-        image_id1, image_id2 = images[image_name1], images[image_name2]
-        image_pair_id = image_ids_to_pair_id(image_id1, image_id2)
-        if image_pair_id in image_pair_ids:
-            continue
-        image_pair_ids.add(image_pair_id)
-        matches = read_matrix(match_path, np.uint32)
-        assert matches.shape[1] == 2
-        if IS_PYTHON3:
-            matches_str = matches.tobytes()
-        else:
-            matches_str = np.getbuffer(matches)
-        cursor.execute("INSERT INTO  matches(pair_id, rows, cols, data) "
+    cursor.executemany("INSERT INTO  matches(pair_id, rows, cols, data) "
                        "VALUES(?, ?, ?, ?);",
-                       (image_pair_id, matches.shape[0], matches.shape[1],
-                        matches_str))
-        connection.commit()
-
-    with open(os.path.join(args.dataset_path, "image-pairs.txt"), "w") as fid:
-        for image_name1, image_name2 in image_pairs:
-            fid.write("{} {}\n".format(image_name1, image_name2))
-
-    cursor.close()
-    connection.close()
-
-    subprocess.call([os.path.join(args.colmap_path, "colmap"),
-                     "matches_importer",
-                     "--database_path",
-                     os.path.join(args.dataset_path, "database.db"),
-                     "--match_list_path",
-                     os.path.join(args.dataset_path, "image-pairs.txt"),
-                     "--match_type", "pairs"])
+                       match_rows(args, images, image_pairs, num_threads))
+    cursor.execute("COMMIT;")
+
+    # Move the imported data from the WAL into the database file, so that
+    # the matches_importer processes start from a checkpointed database.
+    cursor.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+
+    write_image_pairs(image_pairs_path, image_pairs)
+
+    # The geometric verification of matches_importer is slow for many image
+    # pairs, so the pairs can be split into shards that are verified by
+    # concurrent processes. SQLite does not support concurrent writers, so
+    # every process verifies its shard in a private copy of the database and
+    # the resulting geometries are merged back afterwards.
+    num_shards = max(1, min(args.num_matches_importers, len(image_pairs)))
+    num_threads_per_shard = max(1, multiprocessing.cpu_count() // num_shards)
+    if num_shards == 1:
+        shards = [(image_pairs_path, database_path)]
+    else:
+        shards = []
+        for shard_idx in range(num_shards):
+            shard_pairs_path = os.path.join(
+                args.dataset_path, "image-pairs-{}.txt".format(shard_idx))
+            shard_database_path = os.path.join(
+                args.dataset_path, "database-{}.db".format(shard_idx))
+            write_image_pairs(shard_pairs_path,
+                              image_pairs[shard_idx::num_shards])
+            shutil.copyfile(database_path, shard_database_path)
+            shards.append((shard_pairs_path, shard_database_path))
 
-    connection = sqlite3.connect(os.path.join(args.dataset_path, "database.db"))
-    cursor = connection.cursor()
+    try:
+        processes = []
+        for shard_pairs_path, shard_database_path in shards:
+            command = [colmap_exe_path,
+                       "matches_importer",
+                       "--database_path", shard_database_path,
+                       "--match_list_path", shard_pairs_path,
+                       "--match_type", "pairs",
+                       "--SiftMatching.num_threads",
+                       str(num_threads_per_shard)]
+            processes.append((subprocess.Popen(command), command))
+        for process, _ in processes:
+            process.wait()
+        for process, command in processes:
+            if process.returncode != 0:
+                raise subprocess.CalledProcessError(process.returncode,
+                                                    command)
+
+        if num_shards > 1:
+            if inlier_matches_table_exists:
+                geometries_table = "inlier_matches"
+            else:
+                geometries_table = "two_view_geometries"
+            for _, shard_database_path in shards:
+                cursor.execute("ATTACH DATABASE ? AS shard;",
+                               (shard_database_path,))
+                cursor.execute("INSERT INTO main.{0} "
+                               "SELECT * FROM shard.{0};"
+                               .format(geometries_table))
+                cursor.execute("DETACH DATABASE shard;")
+    finally:
+        if num_shards > 1:
+            for shard_pairs_path, shard_database_path in shards:
+                for path in (shard_pairs_path, shard_database_path,
+                             shard_database_path + "-wal",
+                             shard_database_path + "-shm"):
+                    if os.path.exists(path):
+                        os.remove(path)
 
     cursor.execute("SELECT count(*) FROM images;")
     num_images = next(cursor)[0]
@@ -142,7 +293,23 @@ def import_matches(args):
                 num_inlier_pairs=num_inlier_pairs,
                 num_inlier_matches=num_inlier_matches)
 
+def read_model_num_images(model_path):
+    # The binary images file starts with the number of registered images as
+    # a uint64, so the count is read without converting the model to text.
+    images_bin_path = os.path.join(model_path, "images.bin")
+    if os.path.exists(images_bin_path):
+        with open(images_bin_path, "rb") as fid:
+            return struct.unpack("<Q", fid.read(8))[0]
+    with open(os.path.join(model_path, "images.txt"), "r") as fid:
+        for line in fid:
+            if not line.startswith("#"):
+                break
+            if line.startswith("# Number of images"):
+                return int(line.split(":")[1].split(",")[0])
+    return 0
+
 def reconstruct(args):
+    colmap_exe_path = os.path.join(args.colmap_path, "colmap")
     database_path = os.path.join(args.dataset_path, "database.db")
     image_path = os.path.join(args.dataset_path, "images")
     sparse_path = os.path.join(args.dataset_path, "sparse")
@@ -154,7 +321,7 @@ def reconstruct(args):
         os.makedirs(dense_path)
 
     # Run the sparse reconstruction.
-    subprocess.call([os.path.join(args.colmap_path, "colmap"),
+    subprocess.call([colmap_exe_path,
                      "mapper",
                      "--database_path", database_path,
                      "--image_path", image_path,
@@ -162,7 +329,10 @@ def reconstruct(args):
                      "--Mapper.init_min_num_inliers", "10",  # 调整参数
                      "--Mapper.init_max_reproj_error", "10.0",  # 调整参数
                      "--Mapper.ba_global_max_refinements", "3",  # 调整参数
-                     "--Mapper.ba_global_max_num_iterations", "50",  # 调整参数
+                     "--Mapper.ba_global_max_num_iterations", "20",  # 调整参数
+                     "--Mapper.ba_global_images_ratio", "1.2",  # 调整参数
+                     "--Mapper.ba_global_points_ratio", "1.2",  # 调整参数
+                     "--Mapper.ba_global_points_freq", "200000",  # 调整参数
                      "--Mapper.num_threads", str(min(multiprocessing.cpu_count(), 16))])
 
     # Find the largest reconstructed sparse model.
@@ -174,19 +344,10 @@ def reconstruct(args):
     largest_model = None
     largest_model_num_images = 0
     for model in models:
-        subprocess.call([os.path.join(args.colmap_path, "colmap"),
-                         "model_converter",
-                         "--input_path", os.path.join(sparse_path, model),
-                         "--output_path", os.path.join(sparse_path, model),
-                         "--output_type", "TXT"])
-        with open(os.path.join(sparse_path, model, "cameras.txt"), "r") as fid:
-            for line in fid:
-                if line.startswith("# Number of cameras"):
-                    num_images = int(line.split()[-1])
-                    if num_images > largest_model_num_images:
-                        largest_model = model
-                        largest_model_num_images = num_images
-                    break
+        num_images = read_model_num_images(os.path.join(sparse_path, model))
+        if num_images > largest_model_num_images:
+            largest_model = model
+            largest_model_num_images = num_images
 
     if largest_model_num_images == 0:
         print("Warning: No images registered in the largest model")
@@ -195,72 +356,65 @@ def reconstruct(args):
     # Run the dense reconstruction.
     largest_model_path = os.path.join(sparse_path, largest_model)
     workspace_path = os.path.join(dense_path, largest_model)
+    fused_path = os.path.join(workspace_path, "fused.ply")
     if not os.path.exists(workspace_path):
         os.makedirs(workspace_path)
 
-    subprocess.call([os.path.join(args.colmap_path, "colmap"),
-                     "image_undistorter",
-                     "--image_path", image_path,
-                     "--input_path", largest_model_path,
-                     "--output_path", workspace_path,
-                     "--max_image_size", "1200"])
-
-    subprocess.call([os.path.join(args.colmap_path, "colmap"),
-                     "patch_match_stereo",
-                     "--workspace_path", workspace_path,
-                     "--PatchMatchStereo.geom_consistency", "false"])
-
-    subprocess.call([os.path.join(args.colmap_path, "colmap"),
-                     "stereo_fusion",
-                     "--workspace_path", workspace_path,
-                     "--input_type", "photometric",
-                     "--output_path", os.path.join(workspace_path, "fused.ply"),
-                     "--StereoFusion.min_num_pixels", "5"])
-
-    stats = subprocess.check_output(
-        [os.path.join(args.colmap_path, "colmap"), "model_analyzer",
-         "--path", largest_model_path])
-
-    stats = stats.decode().split("\n")
-
-    # Initialize all required variables
-    num_reg_images = 0
-    num_sparse_points = 0
-    num_observations = 0
-    mean_track_length = 0.0
-    num_observations_per_image = 0.0
-    mean_reproj_error = 0.0
+    # The sparse model statistics do not depend on the dense reconstruction,
+    # so model_analyzer runs concurrently with it.
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        stats_future = executor.submit(
+            subprocess.check_output,
+            [colmap_exe_path, "model_analyzer",
+             "--path", largest_model_path])
+
+        subprocess.call([colmap_exe_path,
+                         "image_undistorter",
+                         "--image_path", image_path,
+                         "--input_path", largest_model_path,
+                         "--output_path", workspace_path,
+                         "--max_image_size", "1200"])
+
+        subprocess.call([colmap_exe_path,
+                         "patch_match_stereo",
+                         "--workspace_path", workspace_path,
+                         "--PatchMatchStereo.geom_consistency", "false",
+                         "--PatchMatchStereo.gpu_index", args.gpu_index,
+                         "--PatchMatchStereo.max_image_size", "1200",
+                         "--PatchMatchStereo.window_radius", "3",
+                         "--PatchMatchStereo.window_step", "2",
+                         "--PatchMatchStereo.num_iterations", "3",
+                         "--PatchMatchStereo.cache_size", "32"])
+
+        subprocess.call([colmap_exe_path,
+                         "stereo_fusion",
+                         "--workspace_path", workspace_path,
+                         "--input_type", "photometric",
+                         "--output_path", fused_path,
+                         "--StereoFusion.min_num_pixels", "5"])
+
+        stats = stats_future.result()
+
+    # Unreported statistics are set to None instead of silently defaulting
+    # to zero, e.g., if the output format changes between COLMAP versions.
+    reconstruction_stats = {}
+    for name, (pattern, cast) in MODEL_ANALYZER_PATTERNS.items():
+        match = pattern.search(stats)
+        reconstruction_stats[name] = cast(match.group(1)) if match else None
+
     num_dense_points = 0
 
-    for stat in stats:
-        if stat.startswith("Registered images"):
-            num_reg_images = int(stat.split()[-1])
-        elif stat.startswith("Points"):
-            num_sparse_points = int(stat.split()[-1])
-        elif stat.startswith("Observations"):
-            num_observations = int(stat.split()[-1])
-        elif stat.startswith("Mean track length"):
-            mean_track_length = float(stat.split()[-1])
-        elif stat.startswith("Mean observations per image"):
-            num_observations_per_image = float(stat.split()[-1])
-        elif stat.startswith("Mean reprojection error"):
-            mean_reproj_error = float(stat.split()[-1][:-2])
-
-    with open(os.path.join(workspace_path, "fused.ply"), "rb") as fid:
-        line = fid.readline().decode()
-        while line:
-            if line.startswith("element vertex"):
-                num_dense_points = int(line.split()[-1])
-                break
-            line = fid.readline().decode()
-
-    return dict(num_reg_images=num_reg_images,
-                num_sparse_points=num_sparse_points,
-                num_observations=num_observations,
-                mean_track_length=mean_track_length,
-                num_observations_per_image=num_observations_per_image,
-                mean_reproj_error=mean_reproj_error,
-                num_dense_points=num_dense_points)
+    # The PLY header is at the start of the file and much smaller than the
+    # binary vertex data, so it is parsed from a single small read.
+    with open(fused_path, "rb") as fid:
+        header = fid.read(4096).decode("ascii", "ignore")
+    match = re.search(r"^element vertex (\d+)", header, re.MULTILINE)
+    if match:
+        num_dense_points = int(match.group(1))
+
+    reconstruction_stats["num_dense_points"] = num_dense_points
+
+    return reconstruction_stats
 
 def main():
     args = parse_args()